@@ -1,24 +1,57 @@
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, AsyncIterator, Literal
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument, UpdateOne
+from contextlib import asynccontextmanager
+import asyncio
+import logging
 import os
-import openai
-from datetime import datetime
+import re
+import orjson
+from openai import APITimeoutError, AsyncOpenAI
+from datetime import date, datetime
+from functools import lru_cache
 
 # Assuming you have a database connection similar to this
 # from .db import db  # Your existing database connection
+#
+# Create the app with the analysis lifespan so indexes are built on startup:
+# app = FastAPI(lifespan=analysis_lifespan)
+# app.include_router(analysis_router)
+
+logger = logging.getLogger(__name__)
 
 # Initialize OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
+oai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Limit concurrent OpenAI calls to stay within the rate limit budget
+OAI_SEM = asyncio.Semaphore(int(os.getenv("OAI_CONCURRENCY", "16")))
+OPENAI_CALL_TIMEOUT = 20
+OPENAI_REQUEST_TIMEOUT = 25
+
+# References to running background tasks so they are not garbage collected
+background_tasks = set()
+
+# JSON response that also serializes MongoDB ObjectIds
+def orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+class MongoJSONResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
 
 # Create router for analysis endpoints
-analysis_router = APIRouter(prefix="/analysis", tags=["Analysis"])
+analysis_router = APIRouter(prefix="/analysis", tags=["Analysis"], default_response_class=MongoJSONResponse)
 
 # Pydantic models for request/response
 class StepResult(BaseModel):
     step_id: int
-    step_type: str  # AI_CONVERSATION, AI_CV_GAME, AI_QUIZ
+    step_type: Literal["AI_CONVERSATION", "AI_CV_GAME", "AI_QUIZ"]
     is_successful: Optional[bool] = None
     duration_seconds: Optional[int] = None
     details: Optional[Dict[str, Any]] = None
@@ -27,177 +60,331 @@ class StepAnalysisRequest(BaseModel):
     session_id: str
     step_result: StepResult
 
+class StepBatchAnalysisRequest(BaseModel):
+    session_id: str
+    step_results: List[StepResult]
+
 class SessionInitRequest(BaseModel):
     session_id: str
 
+# Report section that groups the analyses of each step type
+STEP_REPORT_BUCKETS = {
+    "AI_CONVERSATION": "voice_reports",
+    "AI_CV_GAME": "game_reports",
+    "AI_QUIZ": "test_reports"
+}
+
+# Step analyses of reports created before llm_step_reports existed are nested in the report
+LEGACY_STEP_REPORTS_PROJECTION = {f"step_reports.{bucket}": 1 for bucket in STEP_REPORT_BUCKETS.values()}
+
+# Fields of step details that are relevant for the analysis prompt
+STEP_DETAIL_FIELDS = ("score", "correct", "total", "errors")
+
+# Prompt templates for each step type, filled with the step context
+STEP_PROMPT_CONTEXT = """
+Çocuk: {child_name} (Yaş: {child_age})
+Ders: {lesson_name}
+Adım: {step_id} - {step_type}
+Başarılı: {is_successful}
+Süre: {duration_seconds} saniye
+Detaylar: {details}
+
+Lütfen şunları değerlendir:
+"""
+
+STEP_PROMPT_FORMAT = """
+Yanıtını {{"analysis": "değerlendirme metni", "suggestions": ["öneri", ...]}} biçiminde JSON olarak ver.
+"""
+
+STEP_PROMPTS = {
+    "AI_CONVERSATION": "Çocuğun ses etkileşimi performansını analiz et:\n" + STEP_PROMPT_CONTEXT + """1. Çocuğun katılım düzeyi
+2. İletişim becerileri
+3. Öğrenme göstergeleri
+4. Öneriler
+""" + STEP_PROMPT_FORMAT,
+    "AI_CV_GAME": "Çocuğun görsel oyun performansını analiz et:\n" + STEP_PROMPT_CONTEXT + """1. Görsel algı becerileri
+2. El-göz koordinasyonu
+3. Problem çözme yaklaşımı
+4. Öneriler
+""" + STEP_PROMPT_FORMAT,
+    "AI_QUIZ": "Çocuğun quiz performansını analiz et:\n" + STEP_PROMPT_CONTEXT + """1. Anlama düzeyi
+2. Doğru cevap oranı
+3. Kavram öğrenme durumu
+4. Öneriler
+""" + STEP_PROMPT_FORMAT
+}
+
+# Heading the final report puts its suggestion list under
+SUGGESTIONS_HEADING = "ÖNERİLER:"
+SUGGESTIONS_HEADING_PATTERN = re.compile(r"^\W*(?:ÖNERİLER|ÖNERILER|Öneriler)\W*:", re.MULTILINE)
+
+# Maximum number of concurrent OpenAI calls for a batch step analysis
+BATCH_ANALYSIS_CONCURRENCY = 8
+
+# Request validation
+async def parse_oid(session_id: str) -> ObjectId:
+    """Convert session id to ObjectId, rejecting malformed ids with 400"""
+    try:
+        return ObjectId(session_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid session_id")
+
+# Database indexes used by analysis queries
+async def create_analysis_indexes():
+    """Create indexes for report and session lookups"""
+    results = await asyncio.gather(
+        db.llm_reports.create_index("session_id", unique=True),
+        db.llm_step_reports.create_index([("session_id", 1), ("step_id", 1)], unique=True),
+        db.sessions.create_index("child_id"),
+        db.sessions.create_index("lesson_id"),
+        return_exceptions=True
+    )
+    
+    # A unique index fails to build while duplicate documents exist (e.g. llm_reports
+    # created by repeated initialize calls); keep serving and report what to clean up
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Failed to create analysis index, remove duplicate documents and restart: %s", result)
+
+@asynccontextmanager
+async def analysis_lifespan(app):
+    """Prepare analysis collections when the app starts"""
+    await create_analysis_indexes()
+    yield
+
 # Analysis Routes
 @analysis_router.post("/session/initialize")
 async def initialize_session_analysis(request: SessionInitRequest):
     """Initialize analysis when session starts"""
-    try:
-        # Convert string to ObjectId
-        session_oid = ObjectId(request.session_id)
-        
-        # Get session, child, and lesson data
-        session = await db.sessions.find_one({"_id": session_oid})
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found")
-            
-        child = await db.children.find_one({"_id": session["child_id"]})
-        lesson = await db.lessons.find_one({"_id": session["lesson_id"]})
-        
-        # Create initial LLM report document
-        llm_report = {
-            "_id": ObjectId(),
-            "session_id": request.session_id,
-            "child_id": str(session["child_id"]),
-            "step_reports": {
-                "voice_reports": {},
-                "game_reports": {},
-                "test_reports": {},
-                "final_report": {},
-                "suggestion": {}
-            },
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
-        
-        # Insert initial report
-        result = await db.llm_reports.insert_one(llm_report)
-        
-        return {
-            "status": "success",
-            "message": "Session analysis initialized",
-            "report_id": str(result.inserted_id),
-            "session_info": {
-                "child_name": child.get("name") if child else "Unknown",
-                "lesson_name": lesson.get("lesson_name") if lesson else "Unknown"
+    # Convert string to ObjectId
+    session_oid = await parse_oid(request.session_id)
+    
+    # Get session, child, and lesson data
+    session, child, lesson = await load_session_bundle(session_oid)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+        
+    # Create initial LLM report document, reusing it if the session was already initialized
+    now = datetime.utcnow()
+    llm_report = await db.llm_reports.find_one_and_update(
+        {"session_id": request.session_id},
+        {
+            "$setOnInsert": {
+                "child_id": str(session["child_id"]),
+                "step_reports": {
+                    "final_report": {},
+                    "suggestion": {}
+                },
+                "created_at": now,
+                "updated_at": now
             }
+        },
+        projection={"_id": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    
+    return {
+        "status": "success",
+        "message": "Session analysis initialized",
+        "report_id": str(llm_report["_id"]),
+        "session_info": {
+            "child_name": child.get("name") if child else "Unknown",
+            "lesson_name": lesson.get("lesson_name") if lesson else "Unknown"
         }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to initialize session: {str(e)}")
+    }
 
 @analysis_router.post("/session/analyze-step")
 async def analyze_step_completion(request: StepAnalysisRequest):
     """Analyze step completion and update report"""
-    try:
-        session_oid = ObjectId(request.session_id)
-        
-        # Get session data
-        session = await db.sessions.find_one({"_id": session_oid})
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found")
-            
-        # Get child and lesson data for context
-        child = await db.children.find_one({"_id": session["child_id"]})
-        lesson = await db.lessons.find_one({"_id": session["lesson_id"]})
-        
-        # Get current LLM report
-        llm_report = await db.llm_reports.find_one({"session_id": request.session_id})
-        if not llm_report:
-            raise HTTPException(status_code=404, detail="LLM report not found")
-        
-        # Generate step analysis
-        step_analysis = await generate_step_analysis(
-            request.step_result, session, child, lesson
+    session_oid = await parse_oid(request.session_id)
+    
+    # Get session data with child and lesson data for context, and check the report exists
+    (session, child, lesson), llm_report = await asyncio.gather(
+        load_session_bundle(session_oid),
+        db.llm_reports.find_one({"session_id": request.session_id}, {"_id": 1})
+    )
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    if not llm_report:
+        raise HTTPException(status_code=404, detail="LLM report not found")
+    
+    # Generate step analysis
+    step_analysis = await generate_step_analysis(
+        request.step_result, session, child, lesson
+    )
+    
+    # Touch the parent report and store the step in its own document
+    now = datetime.utcnow()
+    await asyncio.gather(
+        db.llm_reports.update_one(
+            {"_id": llm_report["_id"]},
+            {"$set": {"updated_at": now}}
+        ),
+        db.llm_step_reports.update_one(
+            {"session_id": request.session_id, "step_id": request.step_result.step_id},
+            {"$set": {**step_analysis, "updated_at": now}},
+            upsert=True
         )
-        
-        # Update the appropriate report section
-        step_type = request.step_result.step_type
-        step_reports = llm_report["step_reports"]
-        
-        if step_type == "AI_CONVERSATION":
-            step_reports["voice_reports"][f"step_{request.step_result.step_id}"] = step_analysis
-        elif step_type == "AI_CV_GAME":
-            step_reports["game_reports"][f"step_{request.step_result.step_id}"] = step_analysis
-        elif step_type == "AI_QUIZ":
-            step_reports["test_reports"][f"step_{request.step_result.step_id}"] = step_analysis
-        
-        # Update the document
-        await db.llm_reports.update_one(
+    )
+    
+    return {
+        "status": "success",
+        "message": f"Step {request.step_result.step_id} analysis completed",
+        "analysis": step_analysis
+    }
+
+@analysis_router.post("/session/analyze-steps-batch")
+async def analyze_steps_batch(request: StepBatchAnalysisRequest):
+    """Analyze multiple completed steps concurrently and update report once"""
+    session_oid = await parse_oid(request.session_id)
+    
+    # Get session data with child and lesson data for context, and check the report exists
+    (session, child, lesson), llm_report = await asyncio.gather(
+        load_session_bundle(session_oid),
+        db.llm_reports.find_one({"session_id": request.session_id}, {"_id": 1})
+    )
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    if not llm_report:
+        raise HTTPException(status_code=404, detail="LLM report not found")
+    
+    # Generate step analyses concurrently, bounded for OpenAI rate limits
+    semaphore = asyncio.Semaphore(BATCH_ANALYSIS_CONCURRENCY)
+    
+    async def run(step_result: StepResult) -> dict:
+        async with semaphore:
+            return await generate_step_analysis(step_result, session, child, lesson)
+    
+    # A failed or timed out step becomes an error entry instead of discarding the other analyses
+    results = await asyncio.gather(*map(run, request.step_results), return_exceptions=True)
+    step_analyses = [
+        step_error_analysis(step_result, getattr(result, "detail", result))
+        if isinstance(result, BaseException) else result
+        for step_result, result in zip(request.step_results, results)
+    ]
+    
+    # Touch the parent report and store all steps with a single bulk write
+    now = datetime.utcnow()
+    writes = [
+        db.llm_reports.update_one(
             {"_id": llm_report["_id"]},
-            {
-                "$set": {
-                    "step_reports": step_reports,
-                    "updated_at": datetime.utcnow()
-                }
-            }
+            {"$set": {"updated_at": now}}
         )
-        
-        return {
-            "status": "success",
-            "message": f"Step {request.step_result.step_id} analysis completed",
-            "analysis": step_analysis
-        }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to analyze step: {str(e)}")
+    ]
+    if step_analyses:
+        writes.append(db.llm_step_reports.bulk_write([
+            UpdateOne(
+                {"session_id": request.session_id, "step_id": step_analysis["step_id"]},
+                {"$set": {**step_analysis, "updated_at": now}},
+                upsert=True
+            )
+            for step_analysis in step_analyses
+        ], ordered=False))
+    await asyncio.gather(*writes)
+    
+    return {
+        "status": "success",
+        "message": f"{len(step_analyses)} step analyses completed",
+        "analyses": step_analyses
+    }
 
 @analysis_router.get("/session/{session_id}/report")
 async def get_session_report(session_id: str):
     """Get current session analysis report"""
-    try:
-        llm_report = await db.llm_reports.find_one({"session_id": session_id})
-        if not llm_report:
-            raise HTTPException(status_code=404, detail="Report not found")
-        
-        # Convert ObjectId to string for JSON serialization
-        llm_report["_id"] = str(llm_report["_id"])
-        
-        return {
-            "status": "success",
-            "report": llm_report
-        }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to get report: {str(e)}")
+    llm_report, step_reports = await asyncio.gather(
+        db.llm_reports.find_one({"session_id": session_id}),
+        load_step_reports(session_id)
+    )
+    if not llm_report:
+        raise HTTPException(status_code=404, detail="Report not found")
+    
+    llm_report["step_reports"].update(merge_step_reports(llm_report["step_reports"], step_reports))
+    
+    # Serialize ObjectId and datetime fields directly with orjson
+    return MongoJSONResponse({
+        "status": "success",
+        "report": llm_report
+    })
 
 @analysis_router.post("/session/{session_id}/finalize")
-async def finalize_session_analysis(session_id: str):
+async def finalize_session_analysis(session_id: str, session_oid: ObjectId = Depends(parse_oid)):
     """Finalize session when it ends"""
-    try:
-        session_oid = ObjectId(session_id)
-        
-        # Get complete session data
-        session = await db.sessions.find_one({"_id": session_oid})
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found")
-            
-        child = await db.children.find_one({"_id": session["child_id"]})
-        lesson = await db.lessons.find_one({"_id": session["lesson_id"]})
-        
-        # Get LLM report
-        llm_report = await db.llm_reports.find_one({"session_id": session_id})
-        if not llm_report:
-            raise HTTPException(status_code=404, detail="LLM report not found")
-        
-        # Generate final analysis
-        final_analysis = await generate_final_analysis(session, child, lesson, llm_report)
-        
-        # Update with final report
-        await db.llm_reports.update_one(
-            {"_id": llm_report["_id"]},
-            {
-                "$set": {
-                    "step_reports.final_report": final_analysis["final_report"],
-                    "step_reports.suggestion": final_analysis["suggestions"],
-                    "finalized_at": datetime.utcnow(),
-                    "updated_at": datetime.utcnow()
-                }
-            }
-        )
-        
-        return {
-            "status": "success",
-            "message": "Session analysis finalized",
-            "final_analysis": final_analysis
-        }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to finalize session: {str(e)}")
+    # Get complete session data, LLM report and step reports concurrently
+    (session, child, lesson), llm_report, step_reports = await asyncio.gather(
+        load_session_bundle(session_oid),
+        db.llm_reports.find_one({"session_id": session_id}, LEGACY_STEP_REPORTS_PROJECTION),
+        load_step_reports(session_id)
+    )
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+        
+    if not llm_report:
+        raise HTTPException(status_code=404, detail="LLM report not found")
+    
+    step_reports = merge_step_reports(llm_report.get("step_reports", {}), step_reports)
+    
+    # Stream final analysis as it is generated, the report is saved once it completes
+    return StreamingResponse(
+        stream_final_analysis(session, child, lesson, step_reports, llm_report["_id"]),
+        media_type="text/event-stream",
+        # Keep proxies from caching or buffering the stream so tokens reach the client as they arrive
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Helper functions for analysis
+async def load_session_bundle(session_oid: ObjectId) -> tuple:
+    """Fetch session with its child and lesson in a single aggregation"""
+    pipeline = [
+        {"$match": {"_id": session_oid}},
+        {"$limit": 1},
+        {"$project": {"child_id": 1, "lesson_id": 1, "total_score": 1, "status": 1}},
+        {"$lookup": {"from": "children", "localField": "child_id", "foreignField": "_id", "as": "child"}},
+        {"$lookup": {"from": "lessons", "localField": "lesson_id", "foreignField": "_id", "as": "lesson"}},
+        {"$project": {
+            "child_id": 1, "lesson_id": 1, "total_score": 1, "status": 1,
+            "child.name": 1, "child.birthdate": 1, "lesson.lesson_name": 1
+        }}
+    ]
+    
+    results = await db.sessions.aggregate(pipeline).to_list(1)
+    if not results:
+        return None, None, None
+    
+    session = results[0]
+    children = session.pop("child")
+    lessons = session.pop("lesson")
+    
+    return session, children[0] if children else None, lessons[0] if lessons else None
+
+async def load_step_reports(session_id: str) -> dict:
+    """Fetch step analyses of a session grouped by report section"""
+    pipeline = [
+        {"$match": {"session_id": session_id}},
+        {"$sort": {"step_id": 1}},
+        # updated_at is write bookkeeping, keep it out of the report and the final prompt
+        {"$project": {"_id": 0, "session_id": 0, "updated_at": 0}},
+        {"$group": {"_id": "$step_type", "steps": {"$push": "$$ROOT"}}}
+    ]
+    
+    step_reports = {bucket: {} for bucket in STEP_REPORT_BUCKETS.values()}
+    async for group in db.llm_step_reports.aggregate(pipeline):
+        bucket = STEP_REPORT_BUCKETS.get(group["_id"], group["_id"])
+        step_reports.setdefault(bucket, {}).update(
+            {f"step_{step['step_id']}": step for step in group["steps"]}
+        )
+    
+    return step_reports
+
+def merge_step_reports(legacy_reports: dict, step_reports: dict) -> dict:
+    """Merge step analyses nested in a legacy report with those from llm_step_reports"""
+    merged = {}
+    for bucket, steps in step_reports.items():
+        merged[bucket] = {**(legacy_reports.get(bucket) or {}), **steps}
+    return merged
+
 async def generate_step_analysis(step_result: StepResult, session: dict, child: dict, lesson: dict) -> dict:
     """Generate LLM analysis for a specific step"""
     try:
@@ -210,104 +397,84 @@ async def generate_step_analysis(step_result: StepResult, session: dict, child:
             "step_id": step_result.step_id,
             "is_successful": step_result.is_successful,
             "duration_seconds": step_result.duration_seconds,
-            "details": step_result.details
+            "details": compact_details(step_result.details)
         }
         
         # Create specific prompt based on step type
-        if step_result.step_type == "AI_CONVERSATION":
-            prompt = f"""
-            Çocuğun ses etkileşimi performansını analiz et:
-            
-            Çocuk: {context['child_name']} (Yaş: {context['child_age']})
-            Ders: {context['lesson_name']}
-            Adım: {context['step_id']} - {context['step_type']}
-            Başarılı: {context['is_successful']}
-            Süre: {context['duration_seconds']} saniye
-            Detaylar: {context['details']}
-            
-            Lütfen şunları değerlendir:
-            1. Çocuğun katılım düzeyi
-            2. İletişim becerileri  
-            3. Öğrenme göstergeleri
-            4. Öneriler
-            """
-        elif step_result.step_type == "AI_CV_GAME":
-            prompt = f"""
-            Çocuğun görsel oyun performansını analiz et:
-            
-            Çocuk: {context['child_name']} (Yaş: {context['child_age']})
-            Ders: {context['lesson_name']}
-            Adım: {context['step_id']} - {context['step_type']}
-            Başarılı: {context['is_successful']}
-            Süre: {context['duration_seconds']} saniye
-            Detaylar: {context['details']}
-            
-            Lütfen şunları değerlendir:
-            1. Görsel algı becerileri
-            2. El-göz koordinasyonu
-            3. Problem çözme yaklaşımı
-            4. Öneriler
-            """
-        elif step_result.step_type == "AI_QUIZ":
-            prompt = f"""
-            Çocuğun quiz performansını analiz et:
-            
-            Çocuk: {context['child_name']} (Yaş: {context['child_age']})
-            Ders: {context['lesson_name']}
-            Adım: {context['step_id']} - {context['step_type']}
-            Başarılı: {context['is_successful']}
-            Süre: {context['duration_seconds']} saniye
-            Detaylar: {context['details']}
-            
-            Lütfen şunları değerlendir:
-            1. Anlama düzeyi
-            2. Doğru cevap oranı
-            3. Kavram öğrenme durumu
-            4. Öneriler
-            """
+        prompt = STEP_PROMPTS[step_result.step_type].format_map(context)
         
         # Call OpenAI API
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Sen eğitim uzmanısın. Çocukların öğrenme performansını analiz ediyorsun."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=400,
-            temperature=0.7
-        )
-        
-        analysis_text = response['choices'][0]['message']['content']
+        async with asyncio.timeout(OPENAI_REQUEST_TIMEOUT), OAI_SEM:
+            response = await oai.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "Sen eğitim uzmanısın. Çocukların öğrenme performansını analiz ediyorsun."},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=500,
+                temperature=0.7,
+                response_format={"type": "json_object"},
+                timeout=OPENAI_CALL_TIMEOUT
+            )
+        
+        # Truncated JSON cannot be parsed, report it instead of a decode error
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            raise ValueError("yanıt token sınırında kesildi")
+        
+        llm_result = orjson.loads(choice.message.content)
         
         return {
             "step_id": step_result.step_id,
             "step_type": step_result.step_type,
-            "analysis": analysis_text,
+            "analysis": llm_result.get("analysis", ""),
+            "suggestions": llm_result.get("suggestions", []),
             "performance_score": calculate_performance_score(step_result),
             "generated_at": datetime.utcnow().isoformat()
         }
         
+    except (TimeoutError, APITimeoutError):
+        raise HTTPException(status_code=504, detail="Step analysis timed out")
     except Exception as e:
-        return {
-            "step_id": step_result.step_id,
-            "step_type": step_result.step_type,
-            "analysis": f"Analiz hatası: {str(e)}",
-            "performance_score": 0,
-            "generated_at": datetime.utcnow().isoformat()
-        }
+        return step_error_analysis(step_result, e)
+
+def step_error_analysis(step_result: StepResult, error) -> dict:
+    """Build the analysis entry stored for a step whose analysis failed"""
+    return {
+        "step_id": step_result.step_id,
+        "step_type": step_result.step_type,
+        "analysis": f"Analiz hatası: {str(error)}",
+        "suggestions": [],
+        "performance_score": 0,
+        "generated_at": datetime.utcnow().isoformat()
+    }
+
+async def stream_final_analysis(session: dict, child: dict, lesson: dict, step_reports: dict, report_id: ObjectId) -> AsyncIterator[str]:
+    """Relay final analysis events to the client as Server-Sent Events"""
+    # Generation runs in its own task so a slow or disconnected client neither holds
+    # the OpenAI slot and timeout nor cancels saving the result
+    events = asyncio.Queue()
+    spawn_background_task(generate_final_analysis(session, child, lesson, step_reports, report_id, events))
+    
+    while True:
+        event, data = await events.get()
+        if event == "token":
+            yield f"data: {orjson.dumps(data).decode()}\n\n"
+            continue
+        yield f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+        break
 
-async def generate_final_analysis(session: dict, child: dict, lesson: dict, llm_report: dict) -> dict:
-    """Generate final comprehensive analysis"""
+async def generate_final_analysis(session: dict, child: dict, lesson: dict, step_reports: dict, report_id: ObjectId, events: asyncio.Queue):
+    """Generate final comprehensive analysis, publish its tokens and save it to the report"""
+    tokens = []
+    error = None
     try:
-        # Compile all step analyses
-        all_reports = llm_report["step_reports"]
-        
         context = {
             "child_name": child.get("name", "Unknown") if child else "Unknown",
             "lesson_name": lesson.get("lesson_name", "Unknown") if lesson else "Unknown",
             "total_score": session.get("total_score"),
             "status": session.get("status"),
-            "step_reports": all_reports
+            "step_reports": step_reports
         }
         
         prompt = f"""
@@ -326,45 +493,128 @@ async def generate_final_analysis(session: dict, child: dict, lesson: dict, llm_
         3. Gelişim alanları
         4. Gelecek dersler için öneriler
         5. Ebeveyn tavsiyeleri
-        """
-        
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Sen çocuk eğitimi uzmanısın. Kapsamlı öğrenme değerlendirmeleri yapıyorsun."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=600,
-            temperature=0.7
-        )
         
-        final_text = response['choices'][0]['message']['content']
+        En sonda "{SUGGESTIONS_HEADING}" başlığı altında en fazla 5 uygulanabilir öneriyi
+        her biri "- " ile başlayan ayrı satırlarda yaz.
+        """
         
-        return {
+        # Publish each token as soon as it arrives, plain text so clients can render it directly
+        finish_reason = None
+        async with asyncio.timeout(OPENAI_REQUEST_TIMEOUT), OAI_SEM:
+            stream = await oai.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "Sen çocuk eğitimi uzmanısın. Kapsamlı öğrenme değerlendirmeleri yapıyorsun."},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=1200,
+                temperature=0.7,
+                timeout=OPENAI_CALL_TIMEOUT,
+                stream=True
+            )
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    finish_reason = chunk.choices[0].finish_reason or finish_reason
+                    token = chunk.choices[0].delta.content
+                    if token:
+                        tokens.append(token)
+                        events.put_nowait(("token", token))
+        
+        if finish_reason == "length":
+            raise ValueError("yanıt token sınırında kesildi")
+        
+    except (TimeoutError, APITimeoutError):
+        error = "Final analysis timed out"
+    except Exception as e:
+        error = str(e)
+    
+    final_text = "".join(tokens)
+    
+    if error is None:
+        final_analysis = {
             "final_report": final_text,
             "suggestions": extract_suggestions(final_text),
-            "overall_score": calculate_overall_score(session, all_reports),
-            "generated_at": datetime.utcnow().isoformat()
-        }
-        
-    except Exception as e:
-        return {
-            "final_report": f"Final analiz hatası: {str(e)}",
-            "suggestions": ["Teknik hata nedeniyle öneri üretilemedi"],
-            "overall_score": 0,
+            "overall_score": calculate_overall_score(session, step_reports),
             "generated_at": datetime.utcnow().isoformat()
         }
+        events.put_nowait(("final", final_analysis))
+        await save_final_analysis(session["_id"], report_id, final_analysis, "completed")
+        return
+    
+    # Any interruption keeps the text streamed so far on the report and marks the analysis failed
+    logger.warning("Final analysis of report %s failed after %d tokens: %s", report_id, len(tokens), error)
+    final_analysis = {
+        "final_report": final_text or f"Final analiz hatası: {error}",
+        "suggestions": extract_suggestions(final_text) or ["Teknik hata nedeniyle öneri üretilemedi"],
+        "overall_score": 0,
+        "generated_at": datetime.utcnow().isoformat()
+    }
+    events.put_nowait(("error", {"detail": f"Final analysis failed: {error}"}))
+    await save_final_analysis(session["_id"], report_id, final_analysis, "failed")
+
+async def save_final_analysis(session_oid: ObjectId, report_id: ObjectId, final_analysis: dict, analysis_status: str):
+    """Update report and session with final analysis"""
+    now = datetime.utcnow()
+    
+    # The session report is shown as a fallback summary, so never store an error text there
+    session_update = {"llm_analysis_status": analysis_status}
+    if analysis_status == "completed":
+        session_update["llm_analysis_report"] = final_analysis["final_report"]
+    
+    # Report and session writes go to different collections, so run them concurrently
+    await asyncio.gather(
+        db.llm_reports.update_one(
+            {"_id": report_id},
+            {
+                "$set": {
+                    "step_reports.final_report": final_analysis["final_report"],
+                    "step_reports.suggestion": final_analysis["suggestions"],
+                    "finalized_at": now,
+                    "updated_at": now
+                }
+            }
+        ),
+        db.sessions.update_one(
+            {"_id": session_oid},
+            {"$set": session_update}
+        )
+    )
+
+def spawn_background_task(coro):
+    """Run a coroutine detached from the request, logging its failure"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(finish_background_task)
+
+def finish_background_task(task: asyncio.Task):
+    """Release a finished background task and log its exception"""
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed", exc_info=task.exception())
 
 # Utility functions
+def compact_details(details: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Keep only the step detail fields used by the analysis prompt"""
+    if not details:
+        return {}
+    return {key: details[key] for key in STEP_DETAIL_FIELDS if key in details}
+
 def calculate_age(birthdate) -> int:
     """Calculate age from birthdate"""
     try:
-        today = datetime.now()
-        age = today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
-        return age
-    except:
+        return _age_from_iso(birthdate.isoformat(), date.today().isoformat())
+    except (AttributeError, TypeError):
         return 0
 
+@lru_cache(maxsize=4096)
+def _age_from_iso(birthdate_iso: str, today_iso: str) -> int:
+    """Calculate age from ISO dates, memoized per birthdate and day"""
+    birthdate = datetime.fromisoformat(birthdate_iso)
+    today = date.fromisoformat(today_iso)
+    return today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
+
 def calculate_performance_score(step_result: StepResult) -> int:
     """Calculate performance score for a step"""
     if step_result.is_successful is None:
@@ -381,23 +631,23 @@ def calculate_performance_score(step_result: StepResult) -> int:
     
     return min(100, max(0, int(base_score)))
 
+def extract_suggestions(final_text: str) -> List[str]:
+    """Extract the suggestion list that ends the final report"""
+    matches = list(SUGGESTIONS_HEADING_PATTERN.finditer(final_text))
+    if not matches:
+        return []
+    
+    suggestions = []
+    for line in final_text[matches[-1].end():].splitlines():
+        line = line.strip()
+        if line.startswith("-"):
+            suggestions.append(line.lstrip("- ").strip())
+    
+    return suggestions[:5]
+
 def calculate_overall_score(session: dict, all_reports: dict) -> int:
     """Calculate overall session score"""
     try:
         return session.get("total_score", 0)
     except:
         return 0
-
-def extract_suggestions(final_text: str) -> List[str]:
-    """Extract actionable suggestions from final analysis"""
-    # Simple extraction - can be improved with more sophisticated NLP
-    suggestions = []
-    lines = final_text.split('\n')
-    
-    for line in lines:
-        line = line.strip()
-        if any(keyword in line.lower() for keyword in ['öneri', 'tavsiye', 'gelişim', 'çalış']):
-            if len(line) > 10:  # Meaningful suggestions
-                suggestions.append(line)
-    
-    return suggestions[:5]  # Limit to 5 suggestions
\ No newline at end of file
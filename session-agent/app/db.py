@@ -6,5 +6,13 @@ load_dotenv()
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
 MONGODB_DB = os.getenv("MONGODB_DB", "test_db")
 
-client = AsyncIOMotorClient(MONGODB_URI)
-db = client[MONGODB_DB] 
\ No newline at end of file
+client = AsyncIOMotorClient(
+    MONGODB_URI,
+    maxPoolSize=200,
+    minPoolSize=20,
+    compressors="zstd",
+    retryWrites=True,
+    serverSelectionTimeoutMS=3000,
+    waitQueueTimeoutMS=2000
+)
+db = client[MONGODB_DB]
\ No newline at end of file
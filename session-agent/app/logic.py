@@ -1,19 +1,25 @@
+import asyncio
 import os
-import openai
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Configure OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
+oai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-def analyze_session(session: dict) -> dict:
+# Cap concurrent OpenAI calls of this app
+OAI_SEM = asyncio.Semaphore(int(os.getenv("OAI_CONCURRENCY", "16")))
+OPENAI_CALL_TIMEOUT = 20
+OPENAI_REQUEST_TIMEOUT = 25
+
+async def analyze_session(session: dict) -> dict:
     steps = session.get('step_results', [])
     completed_steps = [s for s in steps if s.get('is_successful')]
     avg_duration = sum(s.get('duration_seconds', 0) for s in steps) / len(steps) if steps else 0
 
     # Generate LLM analysis
-    llm_summary = generate_llm_analysis(session)
+    llm_summary = await generate_llm_analysis(session)
     
     return {
         "session_id": session.get('_id'),
@@ -25,7 +31,7 @@ def analyze_session(session: dict) -> dict:
         }
     }
 
-def generate_llm_analysis(session: dict) -> str:
+async def generate_llm_analysis(session: dict) -> str:
     """Generate real-time LLM analysis of the session"""
     try:
         # Prepare session data for analysis
@@ -54,17 +60,19 @@ def generate_llm_analysis(session: dict) -> str:
         """
         
         # Call OpenAI API
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are an educational assessment expert. Analyze session data and provide insights in Turkish."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=300,
-            temperature=0.7
-        )
+        async with asyncio.timeout(OPENAI_REQUEST_TIMEOUT), OAI_SEM:
+            response = await oai.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": "You are an educational assessment expert. Analyze session data and provide insights in Turkish."},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=300,
+                temperature=0.7,
+                timeout=OPENAI_CALL_TIMEOUT
+            )
         
-        return response['choices'][0]['message']['content']
+        return response.choices[0].message.content
         
     except Exception as e:
         # Fallback to original summary if LLM fails
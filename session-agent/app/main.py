@@ -1,5 +1,22 @@
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from pymongo.errors import ServerSelectionTimeoutError
+from .db import client
 from .routes import router
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open pooled connections before the first request pays the handshake
+    try:
+        await client.admin.command("ping")
+    except ServerSelectionTimeoutError:
+        # Still start, the driver keeps retrying and requests fail until MongoDB is reachable
+        logger.error("MongoDB is not reachable at startup", exc_info=True)
+    yield
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 app.include_router(router)
\ No newline at end of file
@@ -10,5 +10,5 @@ async def analyze(session_id: str):
     session = await db.sessions.find_one({"_id": session_id})
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
-    analysis = analyze_session(session)
+    analysis = await analyze_session(session)
     return analysis
\ No newline at end of file